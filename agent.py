@@ -1,13 +1,14 @@
 import sys
 import json
-import re
 import os
+from concurrent.futures import ThreadPoolExecutor
 from .tools import Toolbox
 from .llm import LLMClient
 from .prompts import (
     SYSTEM_PROMPT, 
-    IDENTIFY_FILES_PROMPT, 
-    PLAN_TASK_PROMPT, 
+    PROJECT_FILES_PROMPT,
+    TASK_PROMPT,
+    CYCLE_PROMPT,
     GENERATE_DIFF_PROMPT, 
     WRITE_FILE_PROMPT,
     format_file_context
@@ -21,6 +22,69 @@ RED = "\033[91m"
 RESET = "\033[0m"
 BOLD = "\033[1m"
 
+# History compaction: rough chars-per-token estimate, the number of recent
+# messages that are never compacted, how much of an older one survives, and
+# the marker appended to it.
+CHARS_PER_TOKEN = 4
+KEEP_RECENT_MESSAGES = 4
+SUMMARY_CHARS = 300
+TRUNCATED_MARKER = "\n...[truncated]..."
+
+# Reading is I/O-bound, so context files are read concurrently
+READ_WORKERS = 8
+
+# Per-call generation limits. The cycle reply is a small JSON object; code replies
+# stop at a closing fence followed by a blank line, i.e. before any trailing chatter.
+CYCLE_MAX_TOKENS = 512
+CODE_STOP = ["```\n\n"]
+
+def extract_first_json(s, open_ch="{", close_ch="}"):
+    """
+    Return the first balanced open_ch ... close_ch span in s, or None.
+    Single linear pass (no regex backtracking); brackets inside JSON string
+    literals are skipped so code snippets in values don't unbalance the count.
+    """
+    depth = 0
+    start = -1
+    in_string = False
+    escaped = False
+    for i, ch in enumerate(s):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == open_ch:
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == close_ch and depth:
+            depth -= 1
+            if depth == 0:
+                return s[start:i + 1]
+        elif ch == '"' and depth:
+            # Only track strings inside the object; quotes in surrounding prose don't matter
+            in_string = True
+    return None
+
+def extract_code_block(s):
+    """
+    Return the body of the first ``` fenced block in s, or None if there is none.
+    An unterminated block (closing fence eaten by a stop sequence) runs to the end.
+    """
+    fence = s.find("```")
+    if fence < 0:
+        return None
+    body = s.find("\n", fence)
+    if body < 0:
+        return None
+    end = s.find("```", body + 1)
+    if end < 0:
+        return s[body + 1:]
+    return s[body + 1:end]
+
 class DaAgent:
     def __init__(self, config):
         self.config = config
@@ -28,6 +92,12 @@ class DaAgent:
         self.llm = LLMClient(config)
         self.history = []
         self.project_root = os.getcwd()
+        # Files read for the prompt in the current run(), reused across cycles while
+        # their mtime is unchanged
+        self.file_context = {}
+        self.file_mtimes = {}
+        # (directory mtimes, listing) so the listing is only rebuilt when one changes
+        self._listing = None
 
     def print_step(self, step, msg):
         print(f"{BOLD}{BLUE}[{step}]{RESET} {msg}")
@@ -43,92 +113,171 @@ class DaAgent:
         ans = input(f"{BOLD}Allow? [y/N]: {RESET}").strip().lower()
         return ans == "y"
 
+    def read_context_file(self, fpath):
+        """
+        Return (content, changed) for fpath, re-reading only when its mtime moved.
+        content is None if the file cannot be read.
+        """
+        try:
+            mtime = os.stat(fpath).st_mtime_ns
+        except (OSError, TypeError, ValueError):
+            # Missing file, or the model handed us something that is not a path
+            return None, False
+        if fpath in self.file_context and self.file_mtimes.get(fpath) == mtime:
+            return self.file_context[fpath], False
+        content = self.toolbox.call("read_file", path=fpath)
+        if content.startswith("Error"):
+            return None, False
+        self.file_context[fpath] = content
+        self.file_mtimes[fpath] = mtime
+        return content, True
+
+    def list_project_files(self):
+        """
+        List project files, only walking the tree again when one of the directories
+        it covers changed. list_files goes two levels deep, so that is "." and its
+        visible subdirectories: adding or removing an entry bumps its parent's mtime.
+        """
+        key = self._listing_key()
+        if self._listing is None or self._listing[0] != key:
+            self._listing = (key, self.toolbox.call("list_files", path="."))
+        return self._listing[1]
+
+    @staticmethod
+    def _listing_key():
+        """mtime_ns of every directory list_files walks (one scandir, one stat per subdir)."""
+        key = [(".", os.stat(".").st_mtime_ns)]
+        with os.scandir(".") as it:
+            for e in it:
+                if not e.name.startswith(".") and e.is_dir() and not e.is_symlink():
+                    key.append((e.name, e.stat().st_mtime_ns))
+        key.sort()
+        return tuple(key)
+
+    def compact_history(self, messages):
+        """
+        Once the conversation nears num_ctx, cut older turns down to short summaries.
+        Rewriting history resets the server's prefix cache, so this only happens
+        when the alternative is overflowing the context window. The system prompt
+        and task (messages[0:2]) and the most recent turns are left untouched.
+        """
+        budget = self.config.context_window * CHARS_PER_TOKEN * 3 // 4
+        if sum(len(m["content"]) for m in messages) <= budget:
+            return
+        self.log("Conversation near context limit, compacting older turns.")
+        truncated = False
+        for m in messages[2:-KEEP_RECENT_MESSAGES]:
+            # Already-compacted turns are exactly SUMMARY_CHARS + marker long: leave them
+            if len(m["content"]) > SUMMARY_CHARS + len(TRUNCATED_MARKER):
+                m["content"] = m["content"][:SUMMARY_CHARS] + TRUNCATED_MARKER
+                truncated = True
+        if truncated:
+            # File contents shown in those turns may be gone now; forget what was
+            # sent so read_context_file reports the next request as changed
+            self.file_context.clear()
+            self.file_mtimes.clear()
+
+    def converse(self, messages, prompt, **chat_kwargs):
+        """Append a user turn to the conversation, get the reply and append it too."""
+        self.compact_history(messages)
+        messages.append({"role": "user", "content": prompt})
+        reply = self.llm.chat(messages, **chat_kwargs)
+        messages.append({"role": "assistant", "content": reply})
+        return reply
+
     def run(self, task):
         self.print_step("INIT", f"Task: {task}")
         step_count = 0
+        # The sent-files cache belongs to one conversation: a new task starts a new
+        # one, so every file it asks for must be sent again
+        self.file_context.clear()
+        self.file_mtimes.clear()
+
+        # One append-only conversation per task: the system prompt and task stay
+        # at the front and every sub-step is appended, so the server can reuse
+        # the KV cache for the shared prefix instead of re-prefilling it.
+        # The file listing is large and rarely changes, so it lives in that static
+        # prefix too rather than being repeated in every cycle's prompt.
+        all_files = self.list_project_files()
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT + PROJECT_FILES_PROMPT.format(all_files=all_files)},
+            {"role": "user", "content": TASK_PROMPT.format(task=task)}
+        ]
+        new_context = {}
         
         while step_count < 10: # Safety limit for now
             step_count += 1
             print(f"\n{BOLD}--- Cycle {step_count} ---{RESET}")
             
-            # 1. Identify Context
-            self.print_step("CONTEXT", "Identifying relevant files...")
-            # We list files first to give the model a hint
-            all_files = self.toolbox.call("list_files", path=".")
-            prompt = IDENTIFY_FILES_PROMPT.format(task=task) + f"\n\nAvailable Files:\n{all_files}"
-            
-            messages = [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt}
-            ]
-            
-            response = self.llm.chat(messages)
+            # 1. Decide: one call returns the files to read, the plan and the next action
+            self.print_step("PLAN", "Deciding next step...")
+            # Refresh the listing only if "." changed (e.g. a file was created); this
+            # rewrites the prefix, so it costs one full prefill.
+            listing = self.list_project_files()
+            if listing != all_files:
+                all_files = listing
+                messages[0]["content"] = SYSTEM_PROMPT + PROJECT_FILES_PROMPT.format(all_files=all_files)
+            # Files read last cycle are shown now, so the plan can build on them.
+            # That cycle's action may have edited one since it was read: show what
+            # is on disk now (one stat each when unchanged), drop what is gone.
+            for fpath in list(new_context):
+                content, _ = self.read_context_file(fpath)
+                if content is None:
+                    del new_context[fpath]
+                else:
+                    new_context[fpath] = content
+            cycle_prompt = CYCLE_PROMPT.format(file_context=format_file_context(new_context) or "(none)")
+            # Stop generating as soon as the JSON object closes
+            response = self.converse(
+                messages,
+                cycle_prompt,
+                stop_fn=lambda b: "}" in b and extract_first_json(b) is not None,
+                max_tokens=CYCLE_MAX_TOKENS,
+                json_mode=True
+            )
             
-            # Simple heuristic parsing
+            # JSON mode makes the reply a bare object; scan for one only as a fallback
             try:
-                # Find JSON array
-                match = re.search(r"\[.*\]", response, re.DOTALL)
-                if match:
-                    files_to_read = json.loads(match.group(0))
-                else:
-                    files_to_read = []
-            except:
-                self.log(f"Failed to parse file list: {response}")
-                files_to_read = []
+                cycle_data = json.loads(response)
+            except ValueError:
+                span = extract_first_json(response)
+                try:
+                    cycle_data = json.loads(span) if span else None
+                except ValueError:
+                    self.log(f"JSON parse error on cycle response: {response}")
+                    continue
+            if not isinstance(cycle_data, dict):
+                self.print_step("ERROR", "Model failed to decide check logs.")
+                self.log(response)
+                continue
 
+            # The model may put anything under these keys: keep only the shapes we can use
+            files_to_read = cycle_data.get("files")
+            if not isinstance(files_to_read, list):
+                files_to_read = []
+            files_to_read = [p for p in files_to_read if isinstance(p, str)]
             self.log(f"Relevant files: {files_to_read}")
 
             # 2. Read Files
-            file_context = {}
-            for fpath in files_to_read:
-                content = self.toolbox.call("read_file", path=fpath)
-                if not content.startswith("Error"):
-                    file_context[fpath] = content
+            # Unchanged files are already in the conversation, only send new content
+            new_context = {}
+            with ThreadPoolExecutor(max_workers=READ_WORKERS) as pool:
+                results = pool.map(lambda p: (p, self.read_context_file(p)), files_to_read)
+                for fpath, (content, changed) in results:
+                    if changed:
+                        new_context[fpath] = content
             
             # 3. Plan
-            self.print_step("PLAN", "Generating plan...")
-            formatted_context = format_file_context(file_context)
-            plan_prompt = PLAN_TASK_PROMPT.format(task=task, file_context=formatted_context)
-            messages = [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": plan_prompt}
-            ]
-            plan = self.llm.chat(messages)
+            plan = cycle_data.get("plan", "")
             print(f"{GREEN}{plan}{RESET}")
 
-            # 4. Action Decision (User Loop or Auto)
-            # For simplicity in this version, we act on the plan immediately if it involves code.
-            # We assume the plan implies "Go modify X".
-            # We ask the user or model for the NEXT concrete action? 
-            # To be "disciplined", let's ask the model "Based on the plan, what is the single next file to Create or Modify?"
-            
-            action_prompt = f"""
-            Based on the plan:
-            {plan}
-            
-            What is the NEXT SINGLE file to create or modify?
-            Return JSON: {{"action": "create"|"modify", "path": "filename"}}
-            If verification/command is needed instead, return: {{"action": "command", "command": "shell command"}}
-            If done, return {{"action": "finish"}}
-            """
-            
-            messages.append({"role": "assistant", "content": plan})
-            messages.append({"role": "user", "content": action_prompt})
-            
-            action_resp = self.llm.chat(messages)
-            
-            try:
-                # Naive JSON extract
-                match = re.search(r"\{.*\}", action_resp, re.DOTALL)
-                if match:
-                    action_data = json.loads(match.group(0))
-                else:
-                    self.print_step("ERROR", "Model failed to decide check logs.")
-                    self.log(action_resp)
-                    continue
-            except:
-                 self.log(f"JSON parse error on action: {action_resp}")
-                 continue
+            # 4. Action Decision
+            action_data = cycle_data.get("action") or {}
+            if isinstance(action_data, str):
+                # Small models sometimes collapse {"action": "finish"} to a bare string
+                action_data = {"action": action_data}
+            elif not isinstance(action_data, dict):
+                action_data = {}
 
             action_type = action_data.get("action")
             target_path = action_data.get("path")
@@ -140,18 +289,12 @@ class DaAgent:
             elif action_type == "create":
                 self.print_step("EXEC", f"Creating {target_path}")
                 # Ask for content
-                create_prompt = WRITE_FILE_PROMPT.format(task=task, filepath=target_path)
-                # New context window for coding to avoid pollution
-                code_messages = [
-                     {"role": "system", "content": SYSTEM_PROMPT},
-                     {"role": "user", "content": create_prompt}
-                ]
-                content_resp = self.llm.chat(code_messages)
+                create_prompt = WRITE_FILE_PROMPT.format(filepath=target_path)
+                # Same conversation as the planning turns, so the cached prefix is reused
+                content_resp = self.converse(messages, create_prompt, stop=CODE_STOP)
                 # Extract code block
-                code_match = re.search(r"```.*?\n(.*?)```", content_resp, re.DOTALL)
-                if code_match:
-                    new_content = code_match.group(1)
-                else:
+                new_content = extract_code_block(content_resp)
+                if new_content is None:
                     new_content = content_resp # Fallback
                 
                 if self.ask_tool_confirm("write_file", target_path):
@@ -161,23 +304,16 @@ class DaAgent:
             elif action_type == "modify":
                 self.print_step("EXEC", f"Modifying {target_path}")
                 # Use diff
-                current_content = file_context.get(target_path, "")
-                if not current_content:
-                    # try reading again if missed
-                    current_content = self.toolbox.call("read_file", path=target_path)
+                current_content, _ = self.read_context_file(target_path)
+                if current_content is None:
+                    current_content = ""
                 
-                diff_prompt = GENERATE_DIFF_PROMPT.format(task=task, filepath=target_path, file_content=current_content)
-                code_messages = [
-                     {"role": "system", "content": SYSTEM_PROMPT},
-                     {"role": "user", "content": diff_prompt}
-                ]
-                diff_resp = self.llm.chat(code_messages)
+                diff_prompt = GENERATE_DIFF_PROMPT.format(filepath=target_path, file_content=current_content)
+                diff_resp = self.converse(messages, diff_prompt, stop=CODE_STOP)
                 
                 # Extract diff block
-                diff_match = re.search(r"```.*?\n(.*?)```", diff_resp, re.DOTALL)
-                if diff_match:
-                    diff_content = diff_match.group(1)
-                else:
+                diff_content = extract_code_block(diff_resp)
+                if diff_content is None:
                     diff_content = diff_resp
 
                 if self.ask_tool_confirm("apply_diff", target_path):
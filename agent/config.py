@@ -1,44 +1,57 @@
 import os
-from pydantic import BaseModel, Field
+from dataclasses import dataclass
 
-class AgentConfig(BaseModel):
-    """Configuration for the CLI Agent."""
+@dataclass(frozen=True, slots=True)
+class AgentConfig:
+    """Configuration for the CLI Agent. Immutable: derive variants with dataclasses.replace()."""
     
     # Model Settings
-    model: str = Field(default="phi4:latest", description="Name of the model to use (e.g. llama3, mistral)")
-    api_base: str = Field(default="http://localhost:11434/v1", description="Base URL for the OpenAI-compatible API")
-    api_key: str = Field(default="ollama", description="API Key (dummy for Ollama)")
-    temperature: float = Field(default=0.0, description="Sampling temperature")
-    max_tokens: int = Field(default=4096, description="Max tokens per response")
-    timeout: float = Field(default=1200000, description="Request timeout in seconds")
+    model: str = "phi4:latest"  # Name of the model to use (e.g. llama3, mistral)
+    api_base: str = "http://localhost:11434/v1"  # Base URL for the OpenAI-compatible API
+    api_key: str = "ollama"  # API Key (dummy for Ollama)
+    temperature: float = 0.0  # Sampling temperature
+    max_tokens: int = 4096  # Max tokens per response
+    timeout: float = 1200000  # Request timeout in seconds
+    prompt_caching: bool = False  # Mark the stable prompt prefix with cache_control breakpoints (Anthropic/OpenRouter)
+    backend: str = "auto"  # Server type: ollama, llamacpp or openai (selects KV cache hints); auto = ollama only for an Ollama api_base
+    llamacpp_slots: int = 1  # Number of llama.cpp server slots (-np) to spread prompt prefixes over
+    prompt_cache_dir: str | None = None  # llama.cpp --slot-save-path; slot KV is saved/restored there across restarts
     
     # Safety Settings
-    confirm_dangerous: bool = Field(default=True, description="Ask before executing shell commands or writing files")
-    diff_only: bool = Field(default=False, description="If True, only show diffs, do not apply edits directly without confirmation")
+    confirm_dangerous: bool = True  # Ask before executing shell commands or writing files
+    diff_only: bool = False  # If True, only show diffs, do not apply edits directly without confirmation
     
     # System Settings
-    history_limit: int = Field(default=20, description="Number of turns to keep in context")
+    history_limit: int = 20  # Number of turns to keep in context
+    max_context_tokens: int = 20000  # Token budget for the history after the system prompt (a 64 KB read_file result is ~16k)
+    ui_pace: bool = False  # Pause after each tool output for readability (interactive terminals only)
+    ui_pace_seconds: float = 0.5  # Length of that pause
 
-    @staticmethod
-    def from_env() -> "AgentConfig":
+    @classmethod
+    def from_env(cls) -> "AgentConfig":
         """Load config from environment variables."""
-        saved_model = AgentConfig.load_saved_model()
+        saved_model = cls.load_saved_model()
         default_model = saved_model if saved_model else "llama3.1"
         
-        return AgentConfig(
+        return cls(
             model=os.getenv("AGENT_MODEL", default_model),
             api_base=os.getenv("AGENT_API_BASE", "http://localhost:11434/v1"),
             api_key=os.getenv("AGENT_API_KEY", "ollama"),
             temperature=float(os.getenv("AGENT_TEMPERATURE", "0.0")),
             max_tokens=int(os.getenv("AGENT_MAX_TOKENS", "4096")),
             timeout=float(os.getenv("AGENT_TIMEOUT", "120.0")),
+            prompt_caching=os.getenv("AGENT_PROMPT_CACHE", "false").lower() == "true",
+            backend=os.getenv("AGENT_BACKEND", "auto").lower(),
+            llamacpp_slots=int(os.getenv("AGENT_LLAMACPP_SLOTS", "1")),
+            prompt_cache_dir=os.getenv("AGENT_PROMPT_CACHE_DIR") or None,
             confirm_dangerous=os.getenv("AGENT_CONFIRM", "true").lower() == "true",
             diff_only=os.getenv("AGENT_DIFF_ONLY", "false").lower() == "true",
+            max_context_tokens=int(os.getenv("AGENT_MAX_CONTEXT_TOKENS", "20000")),
+            ui_pace=os.getenv("AGENT_UI_PACE", "false").lower() == "true",
         )
 
     def save_model(self, model_name: str):
-        """Save the selected model to a local config file."""
-        self.model = model_name
+        """Save the selected model to a local config file (used by the next from_env())."""
         config_path = os.path.join(os.getcwd(), ".agent_model")
         try:
             with open(config_path, "w") as f:
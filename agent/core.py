@@ -10,6 +10,11 @@ from .llm import LLMClient
 from .tools import ToolRegistry
 from .utils import parse_llm_action, build_system_prompt
 
+try:
+    import tiktoken
+except ImportError:  # Optional: without it token counts are estimated from length
+    tiktoken = None
+
 console = Console()
 
 class Agent:
@@ -18,18 +23,54 @@ class Agent:
         self.llm = LLMClient(config)
         self.tools = ToolRegistry()
         self.context: List[Dict[str, str]] = []
+        # Token count of each context message, kept parallel to self.context
+        self._ctx_tokens: List[int] = []
+        self._tok = None
+        if tiktoken is not None:
+            try:
+                self._tok = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                # The encoding is downloaded on first use; offline we fall back to estimates
+                pass
         
         # Initialize context with system prompt
-        self.context.append({
-            "role": "system",
-            "content": build_system_prompt(str(self.tools.work_dir))
-        })
+        self._add_message("system", build_system_prompt(str(self.tools.work_dir)))
+
+    def _count_tokens(self, text: str) -> int:
+        """Token count of text (approximate, ~4 chars per token, without tiktoken)."""
+        if self._tok is not None:
+            return len(self._tok.encode(text, disallowed_special=()))
+        return len(text) // 4 + 1
+
+    def _add_message(self, role: str, content: str):
+        self.context.append({"role": role, "content": content})
+        self._ctx_tokens.append(self._count_tokens(content))
+
+    def _trim_context(self):
+        """
+        Drop the oldest turns until the history fits both the message window and the
+        token budget. context[0] (system prompt) and context[1] (the user's task) are
+        never touched: the task must stay visible, and the server's cached KV prefix
+        stays valid. Only the assistant/tool/user turns after them are dropped.
+        """
+        pinned = 2
+        window = self.config.history_limit * 2
+        if len(self.context) > pinned + window:
+            # Keep system prompt + task + last N messages
+            self.context = self.context[:pinned] + self.context[-window:]
+            self._ctx_tokens = self._ctx_tokens[:pinned] + self._ctx_tokens[-window:]
+
+        total = sum(self._ctx_tokens[1:])
+        # Always keep the latest message, even if it alone is over budget
+        while total > self.config.max_context_tokens and len(self.context) > pinned + 1:
+            total -= self._ctx_tokens.pop(pinned)
+            del self.context[pinned]
 
     def run(self, task: str):
         """Main Agent Loop."""
         console.print(Panel(f"[bold green]Task:[/bold green] {task}", title="Agent Started"))
         
-        self.context.append({"role": "user", "content": task})
+        self._add_message("user", task)
         
         try:
             step_count = 0
@@ -39,10 +80,8 @@ class Agent:
                 
                 # 1. Call LLM
                 try:
-                    # Truncate history if needed (simple sliding window)
-                    if len(self.context) > self.config.history_limit * 2:
-                        # Keep system prompt + last N messages
-                        self.context = [self.context[0]] + self.context[-(self.config.history_limit*2):]
+                    # Truncate history if needed (message window + token budget)
+                    self._trim_context()
 
                     response_text = self.llm.completion(self.context)
                 except Exception as e:
@@ -51,7 +90,7 @@ class Agent:
 
                 # 2. Display Result
                 console.print(Panel(response_text, title="Agent Thought", border_style="cyan"))
-                self.context.append({"role": "assistant", "content": response_text})
+                self._add_message("assistant", response_text)
 
                 # 3. Parse Action
                 tool_name, arg1, arg2 = parse_llm_action(response_text)
@@ -62,7 +101,7 @@ class Agent:
                     user_feedback = Prompt.ask("Your response (or 'exit')")
                     if user_feedback.lower() in ["exit", "quit"]:
                         break
-                    self.context.append({"role": "user", "content": user_feedback})
+                    self._add_message("user", user_feedback)
                     continue
                 
                 # 4. Execute Action (with safety checks)
@@ -72,7 +111,7 @@ class Agent:
                 if tool_name in ["edit_file", "write_file"] and arg1:
                     # We silently read logic to ensure policy pass
                     # The user explicitly asked for this behavior
-                    self.tools.read_file(arg1)
+                    self.tools.read_file(arg1, max_bytes=None)
 
                 if self.config.confirm_dangerous and tool_name in ["write_file", "edit_file", "run_command"]:
                     # Custom timeout confirmation
@@ -95,10 +134,11 @@ class Agent:
 
                 # 5. Observe Result
                 console.print(Panel(result, title="Tool Output", border_style="green"))
-                self.context.append({"role": "user", "content": f"TOOL OUTPUT: {result}"})
+                self._add_message("user", f"TOOL OUTPUT: {result}")
                 
-                # Simple heuristic to pause output for readability
-                time.sleep(0.5)
+                # Optional pause for readability; never slows scripted/CI runs
+                if self.config.ui_pace and sys.stdout.isatty():
+                    time.sleep(self.config.ui_pace_seconds)
                 
         except KeyboardInterrupt:
             console.print("\n[bold red]Agent interrupted by user. Exiting...[/bold red]")
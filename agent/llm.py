@@ -1,42 +1,293 @@
+import os
+import json
+import hashlib
+import importlib.util
 import httpx
-from typing import List, Dict, Any, Optional
+from urllib.parse import urlsplit
+from typing import List, Dict, Any, Optional, Callable, Iterator
 from rich.console import Console
 from .config import AgentConfig
 
 console = Console()
 
+# HTTP/2 needs the optional h2 package (httpx[http2]); fall back to HTTP/1.1 without it
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
 class LLMClient:
     """Client for interacting with the Local LLM (Ollama/OpenAI compatible)."""
 
     def __init__(self, config: AgentConfig):
         self.config = config
-        self.client = httpx.Client(
+        # Anthropic needs the beta header to honor cache_control; other providers
+        # that cache prompts (OpenRouter, newer Ollama builds) just read the markers.
+        self.is_anthropic = "anthropic.com" in config.api_base
+        self.prompt_caching = config.prompt_caching or self.is_anthropic
+        # Backend-specific cache hints are extra payload fields that strict servers
+        # reject, so "auto" only sends them to something that looks like Ollama
+        self.backend = config.backend
+        if self.backend == "auto":
+            self.backend = self._detect_backend(config.api_base)
+        headers = {"Authorization": f"Bearer {config.api_key}"}
+        if self.is_anthropic:
+            headers["anthropic-beta"] = "prompt-caching-2024-07-31"
+        # Running totals of cache usage reported by the provider, for observability
+        self.cache_stats = {"cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+        # llama.cpp slot bookkeeping: which prefix each slot holds, and the slot
+        # used by the request in flight so it can be saved once it finishes.
+        self.prompt_cache_dir = config.prompt_cache_dir
+        self._slot_prefix: Dict[int, str] = {}
+        self._pending_slot: Optional[tuple] = None
+        client_options = dict(
             base_url=config.api_base,
-            headers={"Authorization": f"Bearer {config.api_key}"},
+            headers=headers,
+            # Keep connections alive between steps so remote endpoints don't pay a
+            # TCP/TLS handshake per call; HTTP/2 multiplexes concurrent requests.
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_keepalive_connections=16, max_connections=32, keepalive_expiry=300),
             # Robust timeout: wait for connection based on config, but wait forever for read (thinking)
             timeout=httpx.Timeout(connect=config.timeout, read=None, write=60.0, pool=60.0)
         )
+        self.client = httpx.Client(**client_options)
+        self.async_client = httpx.AsyncClient(**client_options)
+
+    def completion(
+        self,
+        messages: List[Dict[str, Any]],
+        stop: Optional[List[str]] = None,
+        max_tokens: Optional[int] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+        grammar: Optional[str] = None,
+    ) -> str:
+        """
+        Get a completion from the model. max_tokens defaults to config.max_tokens.
+        response_format (e.g. {"type": "json_object"}) and grammar (llama.cpp GBNF)
+        constrain decoding on servers that support them.
+        """
+        return self.completion_until(
+            messages, stop=stop, max_tokens=max_tokens, response_format=response_format, grammar=grammar
+        )
+
+    def completion_until(
+        self,
+        messages: List[Dict[str, Any]],
+        stop_fn: Optional[Callable[[str], bool]] = None,
+        stop: Optional[List[str]] = None,
+        max_tokens: Optional[int] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+        grammar: Optional[str] = None,
+    ) -> str:
+        """
+        Stream a completion and return the accumulated text.
+        If stop_fn is given it is called with the buffer after each chunk; once it
+        returns True the stream is closed, aborting the rest of the generation.
+        """
+        buffer = ""
+        stream = self.stream_completion(
+            messages, stop=stop, max_tokens=max_tokens, response_format=response_format, grammar=grammar
+        )
+        try:
+            for delta in stream:
+                buffer += delta
+                if stop_fn and stop_fn(buffer):
+                    break
+        finally:
+            stream.close()
+        self._save_slot()
+        return buffer
+
+    async def acompletion(
+        self,
+        messages: List[Dict[str, Any]],
+        stop: Optional[List[str]] = None,
+        max_tokens: Optional[int] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+        grammar: Optional[str] = None,
+    ) -> str:
+        """Async counterpart of completion(); lets independent calls run concurrently (asyncio.gather)."""
+        payload = self._build_payload(messages, stop, max_tokens, response_format, grammar)
+        parts = []
+        try:
+            async with self.async_client.stream("POST", "/chat/completions", json=payload) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    delta = self._parse_sse_line(line)
+                    if delta is None:
+                        break
+                    parts.append(delta)
+        except httpx.HTTPError as e:
+            console.print(f"[bold red]LLM Error:[/bold red] {e}")
+            raise
+        self._save_slot()
+        return "".join(parts)
+
+    def stream_completion(
+        self,
+        messages: List[Dict[str, Any]],
+        stop: Optional[List[str]] = None,
+        max_tokens: Optional[int] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+        grammar: Optional[str] = None,
+    ) -> Iterator[str]:
+        """Yield content deltas as the model generates them."""
+        payload = self._build_payload(messages, stop, max_tokens, response_format, grammar)
+        try:
+            with self.client.stream("POST", "/chat/completions", json=payload) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    delta = self._parse_sse_line(line)
+                    if delta is None:
+                        break
+                    if delta:
+                        yield delta
+        except httpx.HTTPError as e:
+            console.print(f"[bold red]LLM Error:[/bold red] {e}")
+            raise
 
-    def completion(self, messages: List[Dict[str, str]], stop: Optional[List[str]] = None) -> str:
-        """Get a completion from the model."""
+    def _build_payload(
+        self,
+        messages: List[Dict[str, Any]],
+        stop: Optional[List[str]],
+        max_tokens: Optional[int] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+        grammar: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Assemble the streaming /chat/completions request body."""
+        cache_hints = self._prefix_cache_hints(messages)
+        if self.prompt_caching:
+            messages = self._mark_cache_breakpoints(messages)
         payload = {
             "model": self.config.model,
             "messages": messages,
             "temperature": self.config.temperature,
-            "max_tokens": self.config.max_tokens,
-            "stream": False,
+            "max_tokens": max_tokens or self.config.max_tokens,
+            "stream": True,
+            **cache_hints,
         }
         if stop:
             payload["stop"] = stop
+        if response_format:
+            payload["response_format"] = response_format
+        if grammar:
+            # llama.cpp server extension: grammar-constrained sampling
+            payload["grammar"] = grammar
+        if self.prompt_caching:
+            # Usage (incl. cache counters) is only sent on streams when asked for
+            payload["stream_options"] = {"include_usage": True}
+        return payload
 
+    def _parse_sse_line(self, line: str) -> Optional[str]:
+        """
+        Decode one server-sent event line ("data: {...}") into its content delta.
+        Returns "" for lines without content and None at the "data: [DONE]" terminator.
+        """
+        if not line.startswith("data:"):
+            return ""
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return None
+        chunk = json.loads(data)
+        self._record_cache_usage(chunk.get("usage") or {})
+        choices = chunk.get("choices") or []
+        if not choices:
+            return ""
+        return (choices[0].get("delta") or {}).get("content") or ""
+
+    @staticmethod
+    def _detect_backend(api_base: str) -> str:
+        """Guess the server type from its URL: Ollama's default port or host name, else plain OpenAI."""
+        url = urlsplit(api_base)
+        if url.port == 11434 or "ollama" in (url.hostname or ""):
+            return "ollama"
+        return "openai"
+
+    def _prefix_cache_hints(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Backend-specific payload fields that keep the KV cache of the stable prefix
+        alive between requests (and, for llama.cpp, across restarts).
+        """
+        if self.backend == "ollama":
+            # Keep the model, and with it the cached prefix, loaded between steps
+            return {"keep_alive": "30m"}
+        if self.backend != "llamacpp":
+            return {}
+
+        # Route on the system prompt rather than the whole history: the history grows
+        # every turn, but a conversation must stay on one slot to keep its KV warm.
+        # Same system prompt -> same slot, so llama.cpp only prefills the new tail.
+        stable = [m for m in messages[:1] if m.get("role") == "system"]
+        prefix = json.dumps(stable, sort_keys=True, ensure_ascii=False)
+        prefix_hash = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        slot = int(prefix_hash, 16) % max(1, self.config.llamacpp_slots)
+        self._restore_slot(slot, prefix_hash)
+        self._pending_slot = (slot, prefix_hash)
+        return {"cache_prompt": True, "id_slot": slot}
+
+    def _slot_request(self, slot: int, action: str, prefix_hash: str):
+        """Call llama.cpp's slot save/restore endpoint (served at the root, not under /v1)."""
+        root = self.config.api_base.rstrip("/").removesuffix("/v1")
+        response = self.client.post(
+            f"{root}/slots/{slot}",
+            params={"action": action},
+            json={"filename": f"{prefix_hash}.bin"},
+        )
+        response.raise_for_status()
+
+    def _restore_slot(self, slot: int, prefix_hash: str):
+        """Load a previously saved KV blob for this prefix, e.g. after a restart."""
+        if not self.prompt_cache_dir or self._slot_prefix.get(slot) == prefix_hash:
+            return
+        if not os.path.exists(os.path.join(self.prompt_cache_dir, f"{prefix_hash}.bin")):
+            return
         try:
-            response = self.client.post("/chat/completions", json=payload)
-            response.raise_for_status()
-            data = response.json()
-            return data["choices"][0]["message"]["content"]
+            self._slot_request(slot, "restore", prefix_hash)
+            self._slot_prefix[slot] = prefix_hash
         except httpx.HTTPError as e:
-            console.print(f"[bold red]LLM Error:[/bold red] {e}")
-            raise
+            console.print(f"[dim]Prompt cache restore skipped: {e}[/dim]")
+
+    def _save_slot(self):
+        """Persist the KV of the slot just used, if its prefix has not been saved yet."""
+        pending, self._pending_slot = self._pending_slot, None
+        if not pending:
+            return
+        slot, prefix_hash = pending
+        self._slot_prefix[slot] = prefix_hash
+        if not self.prompt_cache_dir or os.path.exists(os.path.join(self.prompt_cache_dir, f"{prefix_hash}.bin")):
+            return
+        try:
+            self._slot_request(slot, "save", prefix_hash)
+        except httpx.HTTPError as e:
+            console.print(f"[dim]Prompt cache save skipped: {e}[/dim]")
+
+    def _mark_cache_breakpoints(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Tag the stable prefix as cacheable: the system prompt and the turn just before
+        the latest one. The last turn is left untagged since it changes every call.
+        Content that is already a list of blocks is forwarded as-is, apart from the tag.
+        """
+        marked = list(messages)
+        for idx in sorted({0, len(marked) - 2}):
+            if 0 <= idx < len(marked) - 1:
+                msg = dict(marked[idx])
+                content = msg["content"]
+                if isinstance(content, str):
+                    blocks = [{"type": "text", "text": content}]
+                else:
+                    blocks = [dict(block) for block in content]
+                if blocks:
+                    blocks[-1]["cache_control"] = {"type": "ephemeral"}
+                msg["content"] = blocks
+                marked[idx] = msg
+        return marked
+
+    def _record_cache_usage(self, usage: Dict[str, Any]):
+        """Accumulate cache token counts from the response usage block."""
+        created = usage.get("cache_creation_input_tokens") or 0
+        # OpenAI-style providers report cache hits under prompt_tokens_details
+        read = usage.get("cache_read_input_tokens") or (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        self.cache_stats["cache_creation_input_tokens"] += created
+        self.cache_stats["cache_read_input_tokens"] += read
+        if created or read:
+            console.print(f"[dim]Prompt cache: {read} tokens read, {created} tokens written[/dim]")
 
     def check_health(self) -> bool:
         """Verify connection to the model."""
@@ -1,14 +1,47 @@
 import os
+import re
+import codecs
+import shutil
 import subprocess
 import difflib
 import json
-from typing import List, Optional, Tuple
+import uuid
+import time
+from operator import itemgetter
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
 from rich.console import Console
 from rich.syntax import Syntax
 
 console = Console()
 
+# Search/Replace block patterns, compiled once at import.
+# Cheap pre-check that a Search/Replace block is present at all
+_SR_DETECT = re.compile(r'<{3,}\s*SEARCH')
+# Robust regex:
+# 1. <{3,} allows 3 or more <
+# 2. \s* allows spaces before SEARCH
+# 3. (?: .*)? allows trailing text on marker line
+# 4. \s* after marker consumes newline
+_SR_STRICT = re.compile(
+    r'<{3,}\s*SEARCH(?:[^\n]*)\n(.*?)\n={3,}(?:[^\n]*)\n(.*?)\n>{3,}\s*REPLACE',
+    re.DOTALL
+)
+# Fallback for when there is NO newline after markers (rare but happens)
+_SR_LOOSE = re.compile(
+    r'<{3,}\s*SEARCH.*?\n(.*?)\n={3,}.*?\n(.*?)\n>{3,}\s*REPLACE',
+    re.DOTALL
+)
+
+# grep_files limits: directories never descended into, and files too big to scan
+_GREP_SKIP_DIRS = {"node_modules", "__pycache__"}
+_GREP_MAX_BYTES = 2 * 1024 * 1024
+_GREP_TIMEOUT = 60  # seconds, same bound the grep subprocess had
+
+# Rolling-hash parameters for the whitespace-relaxed line scan
+_RK_BASE = 1000003
+_RK_MOD = (1 << 61) - 1
+
 class ToolRegistry:
     """
     Manages available tools and tracks state (e.g. which files have been read).
@@ -16,17 +49,76 @@ class ToolRegistry:
     """
     def __init__(self, work_dir: str = "."):
         self.work_dir = Path(work_dir).resolve()
-        self.read_files = set()  # Tracks absolute paths of files that have been read
+        # Tracks absolute paths of files that have been read, with what was seen:
+        # (st_mtime_ns, st_size, content bytes, or None if only partly read)
+        self.read_files: Dict[str, Tuple[int, int, Optional[bytes]]] = {}
+        # Memoized _resolve_path results, keyed by the raw path argument
+        self._resolved: Dict[str, Path] = {}
+        # Path of the ddgr binary for search_web, resolved on first use
+        self._ddgr_cmd: Optional[str] = None
 
     def _resolve_path(self, path: str) -> Path:
         """Resolve path relative to work_dir."""
+        # resolve() does an lstat/readlink per path component; tools hit the same paths repeatedly
+        cached = self._resolved.get(path)
+        if cached is not None:
+            return cached
         p = (self.work_dir / path).resolve()
+        self._resolved[path] = p
         if not str(p).startswith(str(self.work_dir)):
             # Simple jailbreak protection, though we are local agent so less critical
             # but good for safety.
             pass 
         return p
 
+    def _remember(self, target: Path, data: Optional[bytes]):
+        """Record target as read along with its current stat and (complete) bytes."""
+        st = target.stat()
+        self.read_files[str(target)] = (st.st_mtime_ns, st.st_size, data)
+
+    def _write_atomic(self, target: Path, data: bytes):
+        """
+        Write data to a uniquely named temp file next to target and os.replace() it
+        over target, so the file is never seen half-written. Auto-marks target as read.
+        """
+        # Like mkstemp (random name, O_EXCL so nothing existing is touched), but with
+        # mode 0o666: the kernel applies the umask, as for a plain open()
+        while True:
+            tmp = target.with_name(f".{target.name}.{uuid.uuid4().hex[:8]}.tmp")
+            try:
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+                break
+            except FileExistsError:
+                continue
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            if target.exists():
+                shutil.copymode(target, tmp)  # keep e.g. the executable bit
+            os.replace(tmp, target)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        self._remember(target, data)
+
+    def _cached_bytes(self, target: Path) -> bytes:
+        """
+        Content of an already-read file, reused from read_files while the file is
+        unchanged on disk (same mtime and size). Otherwise it is read again.
+        """
+        mtime_ns, size, data = self.read_files[str(target)]
+        st = target.stat()
+        if data is not None and (st.st_mtime_ns, st.st_size) == (mtime_ns, size):
+            return data
+        if data is not None:
+            console.print(f"[yellow]Warning: {target.name} changed on disk since it was read; using the current content.[/yellow]")
+        data = target.read_bytes()
+        self._remember(target, data)
+        return data
+
     def list_files(self, path: str = ".") -> str:
         """List files in a directory."""
         target = self._resolve_path(path)
@@ -35,17 +127,21 @@ class ToolRegistry:
         
         try:
             # Git-style ignore could be added here, for now simple list
-            files = [f.name for f in target.iterdir()]
-            output = []
-            for f in sorted(files):
-                is_dir = (target / f).is_dir()
-                output.append(f"{f}{'/' if is_dir else ''}")
-            return "\\n".join(output)
+            # scandir's DirEntry.is_dir() uses the d_type from readdir: no stat per entry.
+            # follow_symlinks=False keeps it that way for symlinks too (no stat of the link target)
+            with os.scandir(target) as it:
+                entries = [(e.name, e.is_dir(follow_symlinks=False)) for e in it]
+            entries.sort(key=itemgetter(0))
+            return "\n".join(f"{name}{'/' if is_dir else ''}" for name, is_dir in entries)
         except Exception as e:
             return f"Error listing {path}: {str(e)}"
 
-    def read_file(self, path: str) -> str:
-        """Read a file's content. Marks it as 'read'."""
+    def read_file(self, path: str, max_bytes: Optional[int] = 64_000) -> str:
+        """
+        Read a file's content. Marks it as 'read'.
+        Only the first max_bytes are decoded (a marker notes what was cut);
+        pass max_bytes=None when the full content is needed.
+        """
         target = self._resolve_path(path)
         if not target.exists():
             return f"Error: File {path} not found."
@@ -54,8 +150,39 @@ class ToolRegistry:
             return f"Error: {path} is a directory."
 
         try:
-            content = target.read_text(encoding='utf-8')
-            self.read_files.add(str(target))
+            key = str(target)
+            cached = self.read_files.get(key)
+            full = None
+            if cached is not None and cached[2] is not None:
+                # Re-read of an unchanged file: a stat confirms it, the bytes come from the cache
+                st = target.stat()
+                if (st.st_mtime_ns, st.st_size) == cached[:2]:
+                    full = cached[2]
+            if full is not None:
+                data = full if max_bytes is None else full[:max_bytes]
+                remaining = len(full) - len(data)
+            else:
+                with target.open('rb') as f:
+                    st = os.fstat(f.fileno())
+                    if max_bytes is None:
+                        data = f.read()
+                        remaining = 0
+                    else:
+                        data = f.read(max_bytes)
+                        remaining = max(0, st.st_size - len(data))
+                full = None if remaining else data
+            if remaining:
+                # final=False drops a multi-byte character split at the cut instead of failing
+                content = codecs.getincrementaldecoder('utf-8')().decode(data, final=False)
+            else:
+                content = data.decode('utf-8')
+            if "\r" in content:
+                # Same newline handling as read_text()
+                content = content.replace("\r\n", "\n").replace("\r", "\n")
+            if remaining:
+                content += f"\n... [truncated, {remaining} more bytes]"
+            # Keep the bytes for apply_diff, unless we only saw part of the file
+            self.read_files[key] = (st.st_mtime_ns, st.st_size, full)
             return content
         except Exception as e:
             return f"Error reading {path}: {str(e)}"
@@ -64,15 +191,20 @@ class ToolRegistry:
         """Write content to a file. Requires file to be read first if it exists."""
         target = self._resolve_path(path)
         
+        key = str(target)
+        
+        exists = target.exists()
+        
         # Policy: Must read before write/modify
-        if target.exists() and str(target) not in self.read_files:
+        if exists and key not in self.read_files:
             return f"POLICY ERROR: You must read '{path}' before writing to it."
         
         try:
+            data = content.encode('utf-8')
+            if exists and self._cached_bytes(target) == data:
+                return "No changes (content identical)."
             target.parent.mkdir(parents=True, exist_ok=True)
-            target.write_text(content, encoding='utf-8')
-            # Auto-mark as read since we just wrote it
-            self.read_files.add(str(target))
+            self._write_atomic(target, data)
             return f"Successfully wrote to {path}"
         except Exception as e:
             return f"Error writing to {path}: {str(e)}"
@@ -81,51 +213,37 @@ class ToolRegistry:
         """Apply a unified diff to a file."""
         target = self._resolve_path(path)
         
+        key = str(target)
+        
         if not target.exists():
             return f"Error: Cannot apply diff, file {path} does not exist."
 
-        if str(target) not in self.read_files:
+        if key not in self.read_files:
             return f"POLICY ERROR: You must read '{path}' before applying updates."
 
         try:
-            original = target.read_text(encoding='utf-8').splitlines(keepends=True)
-            
             # Use regex to just find the blocks, ignore exact marker count/spacing in pre-check
-            import re
             # Match roughly <<<< SEARCH ... ==== ... >>>> REPLACE
-            # We use this check to trigger the block parser
-            if re.search(r'<{3,}\s*SEARCH', diff_content):
-                return self._apply_search_replace(target, original, diff_content)
+            # We use this check to trigger the block parser.
+            # Plain substring tests come first: input without the marker words is
+            # rejected by a C-level search instead of stepping the regex over it.
+            if "SEARCH" in diff_content and "REPLACE" in diff_content and _SR_DETECT.search(diff_content):
+                return self._apply_search_replace(target, diff_content)
             
             return "Error: Please use the <<<<<<< SEARCH / ======= / >>>>>>> REPLACE format for edits."
 
         except Exception as e:
             return f"Error patching {path}: {str(e)}"
     
-    def _apply_search_replace(self, target: Path, original_lines: List[str], diff_content: str) -> str:
+    def _apply_search_replace(self, target: Path, diff_content: str) -> str:
         """
         Applies a Search/Replace block with valid whitespace matching and robust parsing.
         """
-        import re
-        # Robust regex:
-        # 1. <{3,} allows 3 or more <
-        # 2. \s* allows spaces before SEARCH
-        # 3. (?: .*)? allows trailing text on marker line
-        # 4. \s* after marker consumes newline
-        pattern = re.compile(
-            r'<{3,}\s*SEARCH(?:[^\n]*)\n(.*?)\n={3,}(?:[^\n]*)\n(.*?)\n>{3,}\s*REPLACE', 
-            re.DOTALL
-        )
-        match = pattern.search(diff_content)
+        match = _SR_STRICT.search(diff_content)
         
         if not match:
-            # Fallback for when there is NO newline after markers (rare but happens)
             # Try looser match
-            pattern_loose = re.compile(
-                r'<{3,}\s*SEARCH.*?\n(.*?)\n={3,}.*?\n(.*?)\n>{3,}\s*REPLACE', 
-                re.DOTALL
-            )
-            match = pattern_loose.search(diff_content)
+            match = _SR_LOOSE.search(diff_content)
 
         if not match:
              return "Error: Invalid Search/Replace format. Ensure you have the headers exactly."
@@ -133,25 +251,27 @@ class ToolRegistry:
         search_block = match.group(1)
         replace_block = match.group(2)
         
-        original_text = "".join(original_lines)
+        # Policy guarantees the file was read; reuse those bytes if it hasn't changed
+        raw = self._cached_bytes(target)
         
-        # 1. Try exact match
-        if search_block in original_text:
-            new_text = original_text.replace(search_block, replace_block, 1)
-            target.write_text(new_text, encoding='utf-8')
+        # 1. Try exact match on the raw bytes: one bytes.find, no decoding or line splitting
+        search_bytes = search_block.encode('utf-8')
+        idx = raw.find(search_bytes)
+        if idx >= 0:
+            new_raw = raw[:idx] + replace_block.encode('utf-8') + raw[idx + len(search_bytes):]
+            if new_raw == raw:
+                return "No changes (content identical)."
+            self._write_atomic(target, new_raw)
             return "Successfully applied edit (exact match)."
 
         # 2. Try normalized whitespace match
-        def normalize(text):
-            return "\\n".join([line.strip() for line in text.splitlines() if line.strip()])
-            
-        norm_search = normalize(search_block)
-        
+        # Only reached on a miss: the stripped line arrays are built here, once each
+        text = raw.decode('utf-8')
+        original_lines = text.splitlines(keepends=True)
         src_lines = [line.strip() for line in original_lines]
         search_lines = [line.strip() for line in search_block.splitlines()]
-        search_lines_no_empty = [l for l in search_lines if l]
         
-        if not search_lines_no_empty:
+        if not any(search_lines):
              return "Error: Search block is empty or only whitespace."
 
         found_at_line = -1
@@ -169,21 +289,56 @@ class ToolRegistry:
         #
         # It's safest to match that exact sequence of (A, empty, B).
         
-        for i in range(len(src_lines) - n_search + 1):
-             window = src_lines[i:i+n_search]
-             if window == search_lines:
-                 found_at_line = i
-                 break
+        # Anchor on the first non-empty search line: the block can only start where
+        # that line occurs (shifted back by any leading blank lines), so only those
+        # positions get the full window compare. No occurrence means no match at all.
+        off, first = next((k, l) for k, l in enumerate(search_lines) if l)
+        last_start = len(src_lines) - n_search
+        candidates = [j - off for j, l in enumerate(src_lines) if l == first]
+        if not candidates:
+            return "Error: Search block not found in file. Ensure exact match (or check your indentation)."
+
+        # A common anchor ("}", "return") can make nearly every line a candidate, so
+        # candidates are checked by rolling (Rabin-Karp) hash in O(1) each: prefix
+        # hashes give any window's hash, and lines are only compared on a hash hit.
+        prefix = [0]
+        for l in src_lines:
+            prefix.append((prefix[-1] * _RK_BASE + hash(l)) % _RK_MOD)
+        target_hash = 0
+        for l in search_lines:
+            target_hash = (target_hash * _RK_BASE + hash(l)) % _RK_MOD
+        shift = pow(_RK_BASE, n_search, _RK_MOD)
+
+        for i in candidates:
+            if i < 0:
+                continue
+            if i > last_start:
+                break
+            if ((prefix[i + n_search] - prefix[i] * shift) % _RK_MOD == target_hash
+                    and src_lines[i:i + n_search] == search_lines):
+                found_at_line = i
+                break
         
         if found_at_line != -1:
-             prefix = original_lines[:found_at_line]
              # We need to know how many lines to replace in ORIGINAL. 
              # n_search is just the number of lines in search block. 
              # Does it map 1:1 to original lines? Yes, because we mapped src_lines 1:1.
-             suffix = original_lines[found_at_line+n_search:]
+             # So the window's character span in text is just a sum of line lengths,
+             # and the edit is one splice of text (no re-join of every line).
+             start = sum(map(len, original_lines[:found_at_line]))
+             end = start + sum(map(len, original_lines[found_at_line:found_at_line + n_search]))
              
-             new_content = "".join(prefix) + replace_block + "\\n" + "".join(suffix)
-             target.write_text(new_content, encoding='utf-8')
+             # Keep a CRLF file consistent: the replacement takes the matched lines' ending
+             newline = "\n"
+             if original_lines[found_at_line + n_search - 1].endswith("\r\n"):
+                 newline = "\r\n"
+                 replace_block = replace_block.replace("\r\n", "\n").replace("\n", "\r\n")
+             
+             new_content = text[:start] + replace_block + newline + text[end:]
+             new_raw = new_content.encode('utf-8')
+             if new_raw == raw:
+                 return "No changes (content identical)."
+             self._write_atomic(target, new_raw)
              return "Successfully applied edit (whitespace-relaxed match)."
 
         return "Error: Search block not found in file. Ensure exact match (or check your indentation)."
@@ -203,36 +358,96 @@ class ToolRegistry:
             stderr = result.stderr
             return_code = result.returncode
             
-            output = f"Exit Code: {return_code}\\n"
+            # Sections are collected and joined once; real newlines, so the model sees separate lines
+            parts = [f"Exit Code: {return_code}\n"]
             if stdout:
-                output += f"STDOUT:\\n{stdout}\\n"
+                parts.append(f"STDOUT:\n{stdout}\n")
             if stderr:
-                output += f"STDERR:\\n{stderr}\\n"
-            return output
+                parts.append(f"STDERR:\n{stderr}\n")
+            return "".join(parts)
         except subprocess.TimeoutExpired:
             return "Error: Command timed out."
         except Exception as e:
             return f"Error running command: {str(e)}"
     
     def grep_files(self, pattern: str, path: str = ".") -> str:
-        """Recursive search for text."""
-        return self.run_command(f"grep -r '{pattern}' {path}")
+        """
+        Recursive search for text, run in-process with a compiled bytes regex.
+        A pattern that is not a valid regex is searched for literally (like grep's
+        basic syntax accepting "main("). The walk stops after _GREP_TIMEOUT seconds
+        and reports what it found so far; a single file's regex run cannot be
+        interrupted, which the _GREP_MAX_BYTES cap keeps short.
+        """
+        try:
+            regex = re.compile(pattern.encode('utf-8'), re.MULTILINE)
+        except re.error:
+            regex = re.compile(re.escape(pattern.encode('utf-8')), re.MULTILINE)
+
+        root = self._resolve_path(path)
+        if not root.exists():
+            return f"Error: {path} does not exist."
+        if root.is_file():
+            matches = self._grep_file(regex, str(root))
+            return "\n".join(matches) or "No matches found."
+
+        deadline = time.monotonic() + _GREP_TIMEOUT
+        matches = []
+        for dirpath, dirnames, filenames in os.walk(root, followlinks=False):
+            # Skip hidden folders (.git etc.) and dependency trees
+            dirnames[:] = [d for d in dirnames if not d.startswith(".") and d not in _GREP_SKIP_DIRS]
+            for name in filenames:
+                matches.extend(self._grep_file(regex, os.path.join(dirpath, name)))
+            if time.monotonic() > deadline:
+                matches.append(f"... [search stopped after {_GREP_TIMEOUT}s, results are partial]")
+                break
+        return "\n".join(matches) or "No matches found."
+
+    def _grep_file(self, regex, fpath: str) -> List[str]:
+        """Matches in one file; skips files that are unreadable, too big or binary."""
+        try:
+            with open(fpath, 'rb') as f:
+                if os.fstat(f.fileno()).st_size > _GREP_MAX_BYTES:
+                    return []
+                data = f.read()
+        except OSError:
+            return []
+        if b"\0" in data[:512]:
+            return []  # binary file
+        return self._line_matches(regex, data, os.path.relpath(fpath, self.work_dir))
+
+    @staticmethod
+    def _line_matches(regex, data: bytes, display_path: str) -> List[str]:
+        """Format regex hits in data as grep-style 'path:line:text', one entry per line."""
+        out = []
+        line_no = 1
+        counted_to = 0
+        last_line_start = -1
+        for m in regex.finditer(data):
+            line_start = data.rfind(b"\n", 0, m.start()) + 1
+            if line_start == last_line_start:
+                continue  # already reported this line
+            line_no += data[counted_to:line_start].count(b"\n")
+            counted_to = line_start
+            last_line_start = line_start
+            line_end = data.find(b"\n", line_start)
+            if line_end < 0:
+                line_end = len(data)
+            text = data[line_start:line_end].decode('utf-8', errors='replace')
+            out.append(f"{display_path}:{line_no}:{text}")
+        return out
 
     def search_web(self, query: str) -> str:
         """Search the internet for documentation or help using ddgr (CMD line)."""
         if not query or not query.strip():
             return "Error: Empty search query."
 
-        # Check if ddgr is installed
-        check = subprocess.run("which ddgr", shell=True, capture_output=True, text=True)
-        if check.returncode != 0:
-             user_bin = os.path.expanduser("~/.local/bin/ddgr")
-             if os.path.exists(user_bin):
-                 cmd_base = user_bin
-             else:
-                return "Error: `ddgr` tool not found. Please install it with `pip install --user ddgr`."
-        else:
-            cmd_base = "ddgr"
+        # Check if ddgr is installed (looked up once; "" records that it is missing)
+        if self._ddgr_cmd is None:
+            user_bin = os.path.expanduser("~/.local/bin/ddgr")
+            self._ddgr_cmd = shutil.which("ddgr") or (user_bin if os.path.exists(user_bin) else "")
+        if not self._ddgr_cmd:
+            return "Error: `ddgr` tool not found. Please install it with `pip install --user ddgr`."
+        cmd_base = self._ddgr_cmd
 
         try:
             # -n 3: 3 results
@@ -265,8 +480,8 @@ class ToolRegistry:
                 title = r.get('title', 'No Title')
                 url = r.get('url', 'No URL')
                 snippet = r.get('abstract', '')
-                output.append(f"- {title}: {url}\\n  {snippet}")
-            return "\\n".join(output)
+                output.append(f"- {title}: {url}\n  {snippet}")
+            return "\n".join(output)
             
         except json.JSONDecodeError:
             # If ddgr returns non-JSON text (sometimes happens on error), return raw
@@ -1,5 +1,10 @@
+from functools import lru_cache
 from typing import List, Dict, Any, Optional, Tuple
 
+# Line prefixes parse_llm_action reacts to; every line is classified by its first 5 chars
+_KEYWORDS = {"TOOL:": "tool", "ARG1:": "arg1", "ARG2:": "arg2", "<<<<<": "search"}
+_SEEK, _AFTER_TOOL, _IN_ARG1, _IN_ARG2 = range(4)
+
 def parse_llm_action(response_text: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
     """
     Parses the LLM output to identify tool calls.
@@ -10,52 +15,50 @@ def parse_llm_action(response_text: str) -> Tuple[Optional[str], Optional[str],
     ARG1: <arg1>
     ARG2: <arg2> (optional)
     """
-    lines = response_text.strip().splitlines()
     tool = None
-    arg1 = None
-    arg2 = ""
+    arg1_parts: Optional[List[str]] = None
+    arg2_parts: List[str] = [""]
+    state = _SEEK
     
     # Very simple parsing logic for robustness with small models
     # We look for the last occurrence of TOOL: to act upon
     # This allows the model to "think" before acting.
+    # One pass over the lines: ARG1 must directly follow TOOL, and each argument
+    # runs until the next keyword line. Parts are joined once at the end.
     
-    for i, line in enumerate(lines):
-        if line.startswith("TOOL:"):
+    for line in response_text.strip().splitlines():
+        kind = _KEYWORDS.get(line[:5])
+        
+        # Most lines are argument continuations, so settle those first
+        if state == _IN_ARG2 and kind != "tool":
+            arg2_parts.append(line)
+            continue
+        
+        if kind == "tool":
             tool = line.split(":", 1)[1].strip()
-            # Look ahead for args
-            # Look ahead for args
-            if i + 1 < len(lines) and lines[i+1].startswith("ARG1:"):
-                arg1 = lines[i+1].split(":", 1)[1].strip()
-                # Check for continuation of ARG1 (multiline)
-                j = i + 2
-                while j < len(lines) and not lines[j].startswith("ARG2:") and not lines[j].startswith("TOOL:"):
-                     # Special case for edit_file: if we see the start of a diff block, it's ARG2
-                     if tool == "edit_file" and lines[j].startswith("<<<<<<< SEARCH"):
-                         break
-                     
-                     # It's part of ARG1 if it's not a keyword
-                     arg1 += "\n" + lines[j]
-                     j += 1
-                
-                # Check for ARG2
-                if j < len(lines):
-                    if lines[j].startswith("ARG2:"):
-                        arg2 = lines[j].split(":", 1)[1].strip()
-                        # continuation for ARG2
-                        k = j + 1
-                        while k < len(lines) and not lines[k].startswith("TOOL:"):
-                            arg2 += "\n" + lines[k]
-                            k += 1
-                    elif tool == "edit_file" and lines[j].startswith("<<<<<<< SEARCH"):
-                        # Implicit ARG2 start for edit_file
-                        arg2 = lines[j]
-                        k = j + 1
-                        while k < len(lines) and not lines[k].startswith("TOOL:"):
-                            arg2 += "\n" + lines[k]
-                            k += 1
+            state = _AFTER_TOOL
+        elif state == _AFTER_TOOL:
+            if kind == "arg1":
+                arg1_parts = [line.split(":", 1)[1].strip()]
+                state = _IN_ARG1
+            else:
+                state = _SEEK
+        elif state == _IN_ARG1:
+            if kind == "arg2":
+                arg2_parts = [line.split(":", 1)[1].strip()]
+                state = _IN_ARG2
+            elif kind == "search" and tool == "edit_file" and line.startswith("<<<<<<< SEARCH"):
+                # Implicit ARG2 start for edit_file
+                arg2_parts = [line]
+                state = _IN_ARG2
+            else:
+                # It's part of ARG1 if it's not a keyword
+                arg1_parts.append(line)
     
-    return tool, arg1, arg2
+    arg1 = "\n".join(arg1_parts) if arg1_parts is not None else None
+    return tool, arg1, "\n".join(arg2_parts)
 
+@lru_cache(maxsize=8)
 def build_system_prompt(work_dir: str) -> str:
     return f"""You are a Local CLI Coding Agent working in {work_dir}.
 You must strictly follow this cycle:
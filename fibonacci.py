@@ -1,14 +1,17 @@
+import sys
 
 def fibonacci(n):
     """Generate a list of Fibonacci numbers up to the nth number."""
     if n <= 0:
         return []  # Return empty list for non-positive inputs
-    elif n == 1:
-        return [0]  # Only one element in sequence when n is 1
 
-    fib = [0, 1]
-    while len(fib) < n:
-        fib.append(fib[-1] + fib[-2])
+    fib = [0] * n  # Preallocated: no resizing while filling it in
+    if n > 1:
+        fib[1] = 1
+    a, b = 0, 1
+    for i in range(2, n):
+        a, b = b, a + b
+        fib[i] = b
     return fib
 
 def main():
@@ -17,7 +20,7 @@ def main():
         if num < 1:
             print("Please enter a positive integer greater than zero.")
         else:
-            print(*fibonacci(num))
+            sys.stdout.write(" ".join(map(str, fibonacci(num))) + "\n")
     except ValueError:
         print("Invalid input. Please enter an integer.")
 
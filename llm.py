@@ -1,50 +1,95 @@
 import json
-import urllib.request
-import urllib.error
+import http.client
 import sys
+from urllib.parse import urlsplit
 
 class LLMClient:
     def __init__(self, config):
         self.config = config
-        self.api_url = f"{config.api_base}/api/chat"
+        # Shared decoder for the streamed chunks (json.loads builds its call path every time)
+        self._decoder = json.JSONDecoder()
+        # One kept-alive connection for every call instead of a new TCP connect per cycle
+        url = urlsplit(config.api_base)
+        conn_cls = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self._conn = conn_cls(url.hostname, url.port, timeout=config.timeout)
+        self._path = f"{url.path.rstrip('/')}/api/chat"
 
-    def chat(self, messages, stop=None):
+    def chat(self, messages, stop=None, stop_fn=None, max_tokens=None, json_mode=False):
         """
         Sends a chat request to the Ollama API.
         messages: list of dicts {'role': 'user', 'content': '...'}
+        stop_fn: optional callable taking the text so far; when it returns True
+                 generation is cut off right there.
+        max_tokens: per-call generation cap, defaults to config.max_tokens.
+        json_mode: constrain decoding so the reply is always valid JSON.
         """
         payload = {
             "model": self.config.model,
             "messages": messages,
-            "stream": False,
+            # Always stream: NDJSON chunks are parsed as they arrive, no second full copy
+            "stream": True,
+            # Keep the model (and its cached prompt prefix) loaded between cycles
+            "keep_alive": "30m",
             "options": {
                 "temperature": self.config.temperature,
                 "num_ctx": self.config.context_window,
-                "num_predict": self.config.max_tokens,
+                "num_predict": max_tokens or self.config.max_tokens,
             }
         }
         
         if stop:
             payload["options"]["stop"] = stop
+        if json_mode:
+            # Ollama's native equivalent of response_format={"type": "json_object"}
+            payload["format"] = "json"
 
         if self.config.verbose:
             print(f"\n[DEBUG] Sending to LLM ({self.config.model})...")
 
-        data = json.dumps(payload).encode("utf-8")
-        req = urllib.request.Request(
-            self.api_url, 
-            data=data, 
-            headers={"Content-Type": "application/json"}
-        )
+        # Compact, raw UTF-8 body: no padding whitespace, no \uXXXX escapes for non-ASCII text
+        data = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
         try:
-            with urllib.request.urlopen(req, timeout=self.config.timeout) as response:
-                result = json.loads(response.read().decode("utf-8"))
-                content = result.get("message", {}).get("content", "")
-                if self.config.verbose:
-                    print(f"[DEBUG] LLM Response chars: {len(content)}")
-                return content
-        except urllib.error.URLError as e:
+            response = self._post(data)
+            if response.status >= 400:
+                response.read()
+                return f"Error communicating with LLM: HTTP Error {response.status}: {response.reason}. check OLLAMA_HOST/api_base."
+            content = self._read_stream(response, stop_fn)
+            if self.config.verbose:
+                print(f"[DEBUG] LLM Response chars: {len(content)}")
+            return content
+        except (OSError, http.client.HTTPException) as e:
+            self._conn.close()
             return f"Error communicating with LLM: {str(e)}. check OLLAMA_HOST/api_base."
         except Exception as e:
+            self._conn.close()
             return f"Error: {str(e)}"
+
+    def _post(self, data):
+        """POST to the chat endpoint on the kept-alive connection."""
+        try:
+            self._conn.request("POST", self._path, body=data, headers={"Content-Type": "application/json"})
+            return self._conn.getresponse()
+        except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError, BrokenPipeError):
+            # The server closed the idle connection (keep-alive expired): reconnect once
+            self._conn.close()
+            self._conn.request("POST", self._path, body=data, headers={"Content-Type": "application/json"})
+            return self._conn.getresponse()
+
+    def _read_stream(self, response, stop_fn=None):
+        """Collect streamed NDJSON chunks until the model is done or stop_fn fires."""
+        parts = []
+        for raw in response:
+            if not raw.strip():
+                continue
+            chunk = self._decoder.decode(raw.decode("utf-8"))
+            parts.append(chunk.get("message", {}).get("content", ""))
+            if chunk.get("done"):
+                # Finish the response so the connection can be reused
+                response.read()
+                break
+            if stop_fn is not None and stop_fn("".join(parts)):
+                # Dropping the connection is what makes Ollama stop generating
+                self._conn.close()
+                break
+        return "".join(parts)
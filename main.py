@@ -1,3 +1,4 @@
+from dataclasses import replace
 import typer
 from rich.console import Console
 from agent.config import AgentConfig
@@ -21,11 +22,11 @@ def run(
     
     
     if model:
-        config.model = model
+        config = replace(config, model=model)
     if diff_only:
-        config.diff_only = True
+        config = replace(config, diff_only=True)
     if auto_approve:
-        config.confirm_dangerous = False
+        config = replace(config, confirm_dangerous=False)
 
     # Handle Special Commands
     if task.lower() in ["list", "models"]:
@@ -1,4 +1,5 @@
 # Prompts optimized for small local models
+from functools import lru_cache
 
 SYSTEM_PROMPT = """You are DaAgent, a disciplined CLI coding assistant.
 You strictly follow instructions and perform work in small, verified steps.
@@ -6,31 +7,30 @@ You effectively use the provided tools to read code, plan changes, and apply fix
 You DO NOT write long explanations. You focus on code and shell commands.
 """
 
-IDENTIFY_FILES_PROMPT = """
-Task: {task}
-
-Which files in the current directory are relevant to this task?
-Use 'list_files' to check potential locations if unsure.
-Reply with a JSON list of file paths ONLY.
-Example: ["src/main.py", "README.md"]
-If no files exist or need to be created, return [].
+PROJECT_FILES_PROMPT = """
+Project Files:
+{all_files}
 """
 
-PLAN_TASK_PROMPT = """
+TASK_PROMPT = """
 Task: {task}
+"""
+
+CYCLE_PROMPT = """
 Context Files:
 {file_context}
 
-Create a minimal step-by-step plan to complete the task.
-Focus on:
-1. What to separate into file creation vs modification.
-2. What commands to run to verify (if applicable).
-
-Keep it short (max 5 steps).
+Decide the next step for the task. Reply with a single JSON object ONLY:
+{{"files": [...], "plan": "...", "action": {{...}}}}
+- "files": paths from the Project Files list whose content you need to see, or [].
+- "plan": a minimal step-by-step plan (max 5 steps) as one string. Separate file creation vs modification and name any verification commands.
+- "action": the NEXT SINGLE step, one of:
+  {{"action": "create"|"modify", "path": "filename"}}
+  {{"action": "command", "command": "shell command"}}
+  {{"action": "finish"}}
 """
 
 GENERATE_DIFF_PROMPT = """
-Task: {task}
 File to Modify: {filepath}
 File Content:
 {file_content}
@@ -44,7 +44,6 @@ Generate a valid Unified Diff to apply the changes required for the task.
 """
 
 WRITE_FILE_PROMPT = """
-Task: {task}
 File to Create: {filepath}
 
 Instruction:
@@ -54,13 +53,19 @@ Output ONLY the code block.
 
 # Helper to format file context
 def format_file_context(files_content):
-    out = ""
-    for path, content in files_content.items():
-        out += f"--- {path} ---\n"
+    # Sorted so the same files always render to the same prompt bytes
+    return _format_ctx(tuple(sorted(files_content.items())))
+
+@lru_cache(maxsize=8)
+def _format_ctx(items):
+    """Render (path, content) pairs; cached since the same set recurs across cycles."""
+    parts = []
+    for path, content in items:
+        parts.append(f"--- {path} ---\n")
         # Truncate if too long (simple heuristic for now)
         if len(content) > 4000:
-            out += content[:1000] + "\n...[truncated]...\n" + content[-1000:]
+            parts.append(content[:1000] + "\n...[truncated]...\n" + content[-1000:])
         else:
-            out += content
-        out += "\n"
-    return out
+            parts.append(content)
+        parts.append("\n")
+    return "".join(parts)
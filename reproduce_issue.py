@@ -1,9 +1,9 @@
-import os
 from agent.tools import ToolRegistry
 
+INITIAL = "Line A\nLine B\nLine C\n".encode("utf-8")
+
 registry = ToolRegistry()
 test_file = "test_reproduce.txt"
-registry.write_file(test_file, "Line A\nLine B\nLine C\n")
 
 # Case 1: Trailing space after SEARCH
 diff_trailing_space = """<<<<<<< SEARCH 
@@ -34,10 +34,11 @@ Line B (mod)
 
 print("--- Testing Reproduction ---")
 for i, diff in enumerate([diff_trailing_space, diff_missing_newline, diff_space_markers, diff_wrong_brackets], 1):
-    # Reset file (delete first to avoid read-check policy issue in test)
-    if os.path.exists(test_file):
-        os.remove(test_file)
-    registry.write_file(test_file, "Line A\nLine B\nLine C\n")
+    # Reset file, then read it as the agent would (Read-Before-Write policy).
+    # Edits replace the file atomically (new inode), so it is reopened by path each time
+    with open(test_file, "wb") as f:
+        f.write(INITIAL)
+    registry.read_file(test_file)
     print(f"Case {i}:")
     res = registry.apply_diff(test_file, diff)
     print(res)
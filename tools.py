@@ -26,21 +26,31 @@ def write_file(path, content):
     except Exception as e:
         return f"Error writing file {path}: {str(e)}"
 
+def _walk(path, depth):
+    """Yield non-hidden file paths under path, descending at most depth levels."""
+    if depth <= 0:
+        return
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError:
+        return
+    subdirs = []
+    for e in entries:
+        if e.name.startswith("."):
+            continue
+        # DirEntry.is_dir() answers from readdir's d_type; only symlinks need a stat
+        if e.is_dir():
+            if not e.is_symlink():
+                subdirs.append(e.path)
+        else:
+            yield e.path
+    for d in subdirs:
+        yield from _walk(d, depth - 1)
+
 def list_files(path=".", depth=2):
     """Lists files in a directory recursively up to a certain depth."""
-    file_list = []
-    base_depth = path.rstrip(os.sep).count(os.sep)
-    for root, dirs, files in os.walk(path):
-        curr_depth = root.count(os.sep)
-        if curr_depth - base_depth >= depth:
-            del dirs[:] # Stop recursing
-            continue
-        # Skip hidden folders
-        dirs[:] = [d for d in dirs if not d.startswith(".")]
-        for f in files:
-            if not f.startswith("."):
-                file_list.append(os.path.join(root, f))
-    return "\n".join(file_list)
+    return "\n".join(_walk(path, depth))
 
 def run_command(command):
     """Runs a shell command and returns output."""
@@ -83,31 +93,33 @@ def apply_unified_diff(path, diff_content):
     if not os.path.exists(path):
         return f"Error: Cannot apply diff, target file {path} does not exist."
     
-    # 2. write diff to temp file
-    diff_path = f"{path}.patch.tmp"
-    with open(diff_path, "w", encoding="utf-8") as f:
-        f.write(diff_content)
-        
-    # 3. run patch command
+    # 2. run patch command, feeding the diff on stdin (no temp file, no shell)
     # -u: unified
-    # -N: ignore patches already applied
     # -p0: assume full path or relative path matches
-    # We try typical patch levels
+    # The target is named explicitly, so the diff headers don't have to match it.
     
-    # Actually, simpler: write the diff, run patch.
     # The model should provide a proper diff header `--- a/file +++ b/file` or just the hunk.
-    # If the model provides just the hunk, `patch` might struggle without filenames.
     # Custom pure-python patching is safer for "fuzzy" model outputs but harder to write perfectly.
     # Let's try `patch` utility first.
+    try:
+        result = subprocess.run(
+            ["patch", "-u", "-p0", path],
+            input=diff_content,
+            capture_output=True,
+            text=True,
+            timeout=30,
+            cwd=os.getcwd()
+        )
+    except subprocess.TimeoutExpired:
+        return "Error: Command timed out after 30 seconds."
+    except Exception as e:
+        return f"Error running command: {str(e)}"
     
-    cmd = f"patch -u {path} -i {diff_path}"
-    result = run_command(cmd)
-    
-    # cleanup
-    if os.path.exists(diff_path):
-        os.remove(diff_path)
-        
-    return result
+    # Same output shape as run_command
+    output = f"STDOUT:\n{result.stdout}\n"
+    if result.stderr:
+        output += f"STDERR:\n{result.stderr}\n"
+    return output
 
 class Toolbox:
     def __init__(self):